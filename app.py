@@ -1,42 +1,258 @@
 from __future__ import annotations
 
-import json
+import base64
+import hashlib
+import io
+import mimetypes
 import os
-import re
+import queue
 import secrets
 import sqlite3
+import string
+import time
 import typing as t
-from dataclasses import dataclass
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from tempfile import SpooledTemporaryFile
 from threading import Lock
-from urllib.parse import urljoin, urlparse
+from urllib.parse import unquote, urljoin, urlparse
 
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
 from flask import (
     Flask,
     Response,
     abort,
     g,
+    has_app_context,
     jsonify,
     redirect,
     render_template,
     request,
-    send_from_directory,
+    send_file,
     session,
+    stream_with_context,
     url_for,
 )
-from functools import wraps
+from flask.json.provider import DefaultJSONProvider
+from functools import lru_cache, wraps
 
-from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.datastructures import FileStorage
+from werkzeug.security import check_password_hash
 from werkzeug.utils import secure_filename
 
+try:
+    from gevent import get_hub
+    from gevent.monkey import is_module_patched
+except ImportError:  # gevent is only needed by the production entrypoint
+    get_hub = None
+
 
 UPLOAD_DIR = Path("uploads")
 DEFAULT_CAPACITY = 50 * 1024 * 1024 * 1024  # 50 GB
-CUSTOM_TOKEN_PATTERN = re.compile(r"^[A-Za-z0-9_-]{4,64}$")
+DEFAULT_POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 512
+BUSY_TIMEOUT_MS = 5000
+# Read pages straight from a shared memory mapping instead of copying them
+# into each connection's page cache through read() calls.
+MMAP_SIZE = 256 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_WORKERS = 4
+DELETE_WORKERS = 2
+STALE_UPLOAD_SECONDS = 60 * 60
+FILE_ID_BYTES = 8
+SHARE_TOKEN_BYTES = 12
+LISTING_BATCH_SIZE = 1000
+MAX_PAGE_SIZE = 500
+# Bodies tools like curl send by default; never stored as the file's type.
+STREAM_FORM_MIMETYPES = frozenset(
+    {"application/x-www-form-urlencoded", "multipart/form-data"}
+)
+USER_CACHE_SIZE = 4096
+USER_CACHE_TTL = 60  # seconds
+PASSWORD_CACHE_SIZE = 2048
+PASSWORD_CACHE_TTL = 300  # seconds
+# Deleting these bytes from a valid custom token leaves nothing behind.
+CUSTOM_TOKEN_BYTES = (string.ascii_letters + string.digits + "-_").encode("ascii")
+URL_PLACEHOLDER = "__placeholder__"
+DAY_CACHE_SIZE = 4096
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+FILE_COLUMNS = (
+    "_id, original_name, stored_name, size, content_type, uploaded_at_ms, "
+    "owner_id, owner_username, share_token, preview_type"
+)
+USER_COLUMNS = (
+    "_id, username, password_hash, is_admin, created_at, hide_media_default, "
+    "copy_url_mode, client_config, api_token, username_lower"
+)
+
+# SQL used by the stores. Keeping the statements as module constants avoids
+# rebuilding them per call and keeps the text stable for sqlite3's
+# per-connection statement cache.
+SQL_INSERT_FILE = """
+    INSERT INTO files (
+        _id,
+        original_name,
+        stored_name,
+        size,
+        content_type,
+        uploaded_at,
+        uploaded_at_ms,
+        owner_id,
+        owner_username,
+        preview_type,
+        share_token
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_LIST_FILES = f"SELECT {FILE_COLUMNS} FROM files ORDER BY uploaded_at_ms DESC"
+SQL_LIST_FILES_BY_OWNER = (
+    f"SELECT {FILE_COLUMNS} FROM files WHERE owner_id = ? ORDER BY uploaded_at_ms DESC"
+)
+# The listing plus the matching stats total in one statement; the scalar
+# subquery is uncorrelated, so SQLite evaluates it once. A LIMIT of -1 means
+# no limit, and both orderings walk an index, so pages need no sort.
+SQL_LIST_FILES_WITH_TOTAL = (
+    f"SELECT {FILE_COLUMNS}, (SELECT total FROM stats WHERE owner_id = '') "
+    "FROM files ORDER BY uploaded_at_ms DESC LIMIT ?1 OFFSET ?2"
+)
+SQL_LIST_FILES_BY_OWNER_WITH_TOTAL = (
+    f"SELECT {FILE_COLUMNS}, (SELECT total FROM stats WHERE owner_id = ?1) "
+    "FROM files WHERE owner_id = ?1 ORDER BY uploaded_at_ms DESC LIMIT ?2 OFFSET ?3"
+)
+SQL_GET_FILE = f"SELECT {FILE_COLUMNS} FROM files WHERE _id = ?"
+SQL_FIND_FILE_BY_TOKEN = f"SELECT {FILE_COLUMNS} FROM files WHERE share_token = ?"
+SQL_RENAME_FILE = "UPDATE files SET original_name = ? WHERE _id = ?"
+SQL_DELETE_FILE = "DELETE FROM files WHERE _id = ?"
+SQL_SET_SHARE_TOKEN = "UPDATE files SET share_token = ? WHERE _id = ?"
+SQL_CLEAR_SHARE_TOKEN = "UPDATE files SET share_token = NULL WHERE _id = ?"
+SQL_RENAME_OWNER = "UPDATE files SET owner_username = ? WHERE owner_id = ?"
+SQL_TOTAL_SIZE = "SELECT total FROM stats WHERE owner_id = ?"
+SQL_ADD_TO_STATS = """
+    INSERT INTO stats (owner_id, total) VALUES (?, ?), ('', ?)
+    ON CONFLICT(owner_id) DO UPDATE SET total = total + excluded.total
+"""
+SQL_SUBTRACT_FROM_STATS = "UPDATE stats SET total = total - ? WHERE owner_id IN (?, '')"
+
+SQL_INSERT_USER = """
+    INSERT INTO users (
+        _id,
+        username,
+        username_lower,
+        password_hash,
+        is_admin,
+        created_at,
+        hide_media_default,
+        copy_url_mode,
+        client_config,
+        api_token
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_HAS_USERS = "SELECT 1 FROM users LIMIT 1"
+SQL_GET_USER = f"SELECT {USER_COLUMNS} FROM users WHERE _id = ?"
+SQL_FIND_USER_BY_USERNAME = f"SELECT {USER_COLUMNS} FROM users WHERE username_lower = ?"
+SQL_FIND_USER_BY_TOKEN = f"SELECT {USER_COLUMNS} FROM users WHERE api_token = ?"
+SQL_USERNAME_TAKEN = "SELECT 1 FROM users WHERE username_lower = ?"
+SQL_USERNAME_TAKEN_BY_OTHER = "SELECT 1 FROM users WHERE username_lower = ? AND _id != ?"
+SQL_SET_API_TOKEN = "UPDATE users SET api_token = ? WHERE _id = ?"
+
+# One UPDATE statement per subset of editable profile fields, indexed by a
+# bitmask over USER_UPDATE_FIELDS, so update_user never formats SQL.
+USER_UPDATE_FIELDS = (
+    "username",
+    "username_lower",
+    "password_hash",
+    "hide_media_default",
+    "copy_url_mode",
+    "client_config",
+)
+SQL_UPDATE_USER = {
+    mask: "UPDATE users SET "
+    + ", ".join(
+        f"{field} = ?"
+        for bit, field in enumerate(USER_UPDATE_FIELDS)
+        if mask & (1 << bit)
+    )
+    + " WHERE _id = ?"
+    for mask in range(1, 1 << len(USER_UPDATE_FIELDS))
+}
+SQL_UPDATE_PASSWORD_HASH = SQL_UPDATE_USER[
+    1 << USER_UPDATE_FIELDS.index("password_hash")
+]
+
+
+password_hasher = PasswordHasher()
+verified_passwords: TTLCache[bytes, bool] = TTLCache(
+    maxsize=PASSWORD_CACHE_SIZE, ttl=PASSWORD_CACHE_TTL
+)
+verified_passwords_lock = Lock()
+
+
+T = t.TypeVar("T")
+
+
+def _green_threads() -> bool:
+    """Return whether ``threading`` has been monkey-patched by gevent."""
+    return get_hub is not None and is_module_patched("threading")
+
+
+def _offload(func: t.Callable[..., T], *args: t.Any) -> T:
+    """Run CPU-bound ``func`` on a real OS thread when serving under gevent.
+
+    Monkey-patched threads are greenlets on the hub's thread, so a slow hash
+    there would stall every other connection of the worker.
+    """
+    if _green_threads():
+        return get_hub().threadpool.apply(func, args)
+    return func(*args)
 
 
-@dataclass
+def hash_password(password: str) -> str:
+    return _offload(password_hasher.hash, password)
+
+
+def password_needs_rehash(password_hash: str) -> bool:
+    if not password_hash.startswith("$argon2"):
+        return True
+    try:
+        return password_hasher.check_needs_rehash(password_hash)
+    except InvalidHashError:
+        return True
+
+
+def _check_password(password_hash: str, password: str) -> bool:
+    if password_hash.startswith("$argon2"):
+        try:
+            return password_hasher.verify(password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    # Accounts created before the switch to argon2 keep werkzeug hashes
+    # until their next successful login.
+    return check_password_hash(password_hash, password)
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    # Successful checks are remembered under a digest of hash and password,
+    # so a changed hash misses and failed attempts always pay for the hasher.
+    key = hashlib.sha256(f"{password_hash}\0{password}".encode()).digest()
+    with verified_passwords_lock:
+        if key in verified_passwords:
+            return True
+    valid = _offload(_check_password, password_hash, password)
+    if valid:
+        with verified_passwords_lock:
+            verified_passwords[key] = True
+    return valid
+
+
+@dataclass(slots=True, frozen=True)
 class User:
     id: str
     username: str
@@ -47,53 +263,82 @@ class User:
     copy_url_mode: str
     client_config: str | None
     api_token: str | None
+    username_lower: str
 
     def check_password(self, password: str) -> bool:
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+
+
+PREVIEW_TYPES = {"image": "image", "video": "video", "audio": "audio", "text": "text"}
+# Preview types that shared links render in the viewer and expose a raw URL for.
+MEDIA_PREVIEW_TYPES = frozenset({"image", "video", "audio"})
+
+
+def datetime_to_ms(value: datetime) -> int:
+    """Return ``value`` as milliseconds since the epoch, rounded down."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - EPOCH) // timedelta(milliseconds=1)
+
 
+@lru_cache(maxsize=DAY_CACHE_SIZE)
+def _utc_date(days: int) -> str:
+    return (EPOCH + timedelta(days=days)).date().isoformat()
 
-@dataclass
+
+def format_timestamp_ms(timestamp_ms: int) -> str:
+    """Format like ``datetime.isoformat()`` in UTC without building a datetime.
+
+    Listings format one timestamp per row; only the date part needs calendar
+    arithmetic, and rows from the same day share it.
+    """
+    seconds, millis = divmod(timestamp_ms, 1000)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    clock = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+    if millis:
+        clock = f"{clock}.{millis:03d}000"
+    return f"{_utc_date(days)}T{clock}+00:00"
+
+
+def preview_type_for(content_type: str) -> str:
+    major, sep, _ = content_type.lower().partition("/")
+    return PREVIEW_TYPES.get(major, "none") if sep else "none"
+
+
+@dataclass(slots=True, frozen=True)
 class FileRecord:
     id: str
     original_name: str
     stored_name: str
     size: int
     content_type: str
-    uploaded_at: datetime
+    uploaded_at_ms: int
     owner_id: str
     owner_username: str
     share_token: str | None = None
+    preview_type: str = "none"
 
     @classmethod
-    def from_document(cls, document: dict[str, t.Any]) -> FileRecord:
-        uploaded_at = document.get("uploaded_at")
-        if isinstance(uploaded_at, str):
-            uploaded_at = datetime.fromisoformat(uploaded_at)
-        if isinstance(uploaded_at, datetime) and uploaded_at.tzinfo is None:
-            uploaded_at = uploaded_at.replace(tzinfo=timezone.utc)
+    def _from_row(cls, row: t.Sequence[t.Any]) -> FileRecord:
+        # Column order follows FILE_COLUMNS.
         return cls(
-            id=str(document["_id"]),
-            original_name=document["original_name"],
-            stored_name=document["stored_name"],
-            size=int(document.get("size", 0)),
-            content_type=document.get("content_type", "application/octet-stream"),
-            uploaded_at=uploaded_at or datetime.now(timezone.utc),
-            owner_id=document.get("owner_id", ""),
-            owner_username=document.get("owner_username", ""),
-            share_token=document.get("share_token"),
+            row[0],
+            row[1],
+            row[2],
+            row[3],
+            row[4] or "application/octet-stream",
+            row[5],
+            row[6],
+            row[7],
+            row[8],
+            row[9],
         )
 
-    def preview_category(self) -> str:
-        content_type = (self.content_type or "").lower()
-        if content_type.startswith("image/"):
-            return "image"
-        if content_type.startswith("video/"):
-            return "video"
-        if content_type.startswith("audio/"):
-            return "audio"
-        if content_type.startswith("text/"):
-            return "text"
-        return "none"
+    @property
+    def uploaded_at_iso(self) -> str:
+        return format_timestamp_ms(self.uploaded_at_ms)
 
     def to_dict(
         self,
@@ -101,19 +346,14 @@ class FileRecord:
         current_user: User | None = None,
         include_owner: bool = False,
     ) -> dict[str, t.Any]:
-        download_url = url_for("download_file", file_id=self.id, _external=True)
-        view_url = url_for("view_file", file_id=self.id, _external=True)
-        share_url = (
-            url_for("serve_shared_file", token=self.share_token, _external=True)
-            if self.share_token
-            else None
-        )
+        urls = file_url_templates()
+        download_url = urls.download.build(self.id)
+        view_url = urls.view.build(self.id)
+        share_url = urls.share.build(self.share_token) if self.share_token else None
         share_raw_url: str | None = None
         if self.share_token:
-            if self.preview_category() in {"image", "video", "audio"}:
-                share_raw_url = url_for(
-                    "serve_shared_file_raw", token=self.share_token, _external=True
-                )
+            if self.preview_type in MEDIA_PREVIEW_TYPES:
+                share_raw_url = urls.share_raw.build(self.share_token)
             else:
                 share_raw_url = share_url
         can_manage = False
@@ -123,13 +363,13 @@ class FileRecord:
             "id": self.id,
             "name": self.original_name,
             "size": self.size,
-            "uploaded_at": self.uploaded_at.isoformat(),
+            "uploaded_at": self.uploaded_at_iso,
             "download_url": download_url,
             "share_url": share_url,
             "share_raw_url": share_raw_url,
             "content_type": self.content_type,
             "view_url": view_url,
-            "preview_type": self.preview_category(),
+            "preview_type": self.preview_type,
             "can_manage": can_manage,
             "is_public": bool(self.share_token),
             "share_token": self.share_token,
@@ -142,14 +382,129 @@ class FileRecord:
         return payload
 
 
+class UrlTemplate(t.NamedTuple):
+    prefix: str
+    suffix: str
+
+    @classmethod
+    def for_endpoint(cls, endpoint: str, key: str) -> UrlTemplate:
+        url = url_for(endpoint, **{key: URL_PLACEHOLDER}, _external=True)
+        prefix, _, suffix = url.partition(URL_PLACEHOLDER)
+        return cls(prefix, suffix)
+
+    def build(self, value: str) -> str:
+        return f"{self.prefix}{value}{self.suffix}"
+
+
+class FileUrlTemplates(t.NamedTuple):
+    download: UrlTemplate
+    view: UrlTemplate
+    share: UrlTemplate
+    share_raw: UrlTemplate
+
+
+def file_url_templates() -> FileUrlTemplates:
+    """Return the per-file URL templates, routed once per request.
+
+    File ids and share tokens only contain URL-safe characters, so listings
+    can join them onto a prebuilt prefix instead of calling ``url_for`` for
+    every record.
+    """
+    templates = g.get("file_url_templates")
+    if templates is None:
+        templates = FileUrlTemplates(
+            download=UrlTemplate.for_endpoint("download_file", "file_id"),
+            view=UrlTemplate.for_endpoint("view_file", "file_id"),
+            share=UrlTemplate.for_endpoint("serve_shared_file", "token"),
+            share_raw=UrlTemplate.for_endpoint("serve_shared_file_raw", "token"),
+        )
+        g.file_url_templates = templates
+    return templates
+
+
+class ConnectionPool:
+    """One writer connection plus a stack of read-only connections.
+
+    SQLite in WAL mode lets readers proceed while a write is in progress, so
+    read paths check out their own connection and only writes are serialized
+    through the single writer.
+    """
+
+    def __init__(self, path: Path, size: int = DEFAULT_POOL_SIZE) -> None:
+        self.path = path
+        self._readers: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue(maxsize=size)
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode NORMAL still keeps the database consistent; it only
+        # defers the fsync from every commit to the next checkpoint.
+        self._writer.execute("PRAGMA synchronous = NORMAL")
+        self._write_lock = Lock()
+
+    def _connect(self, *, readonly: bool = False) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        if readonly:
+            connection.execute("PRAGMA query_only = 1")
+        return connection
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            return self._connect(readonly=True)
+
+    def release(self, connection: sqlite3.Connection) -> None:
+        try:
+            self._readers.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    @contextmanager
+    def reader(self) -> t.Iterator[sqlite3.Connection]:
+        # Reuse the connection checked out for the current request, if any.
+        connection = g.get("db") if has_app_context() else None
+        if connection is not None:
+            yield connection
+            return
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    @contextmanager
+    def writer(self) -> t.Iterator[sqlite3.Connection]:
+        # Connections run in autocommit mode, so a single statement needs no
+        # surrounding transaction; use transaction() to group several.
+        with self._write_lock:
+            yield self._writer
+
+    @contextmanager
+    def transaction(self) -> t.Iterator[sqlite3.Connection]:
+        with self._write_lock:
+            self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            self._writer.execute("COMMIT")
+
+
 class FileStore:
-    def __init__(self, connection: sqlite3.Connection, capacity: int = DEFAULT_CAPACITY) -> None:
-        self.conn = connection
+    def __init__(self, pool: ConnectionPool, capacity: int = DEFAULT_CAPACITY) -> None:
+        self.pool = pool
         self.capacity = capacity
-        self._lock = Lock()
 
     def _generate_id(self) -> str:
-        return secrets.token_hex(8)
+        return secrets.token_hex(FILE_ID_BYTES)
 
     def create(
         self,
@@ -158,140 +513,148 @@ class FileStore:
         content_type: str,
         file_size: int,
         owner: User,
+        file_id: str | None = None,
+        share_token: str | None = None,
     ) -> FileRecord:
-        file_id = self._generate_id()
-        suffix = Path(original_name).suffix
-        stored_name = f"{file_id}{suffix}"
-        uploaded_at = datetime.now(timezone.utc).isoformat()
-        document = {
-            "_id": file_id,
-            "original_name": original_name,
-            "stored_name": stored_name,
-            "size": int(file_size),
-            "content_type": content_type,
-            "uploaded_at": uploaded_at,
-            "owner_id": owner.id,
-            "owner_username": owner.username,
-        }
-        with self._lock, self.conn:
-            self.conn.execute(
-                """
-                INSERT INTO files (
-                    _id,
-                    original_name,
-                    stored_name,
-                    size,
-                    content_type,
-                    uploaded_at,
-                    owner_id,
-                    owner_username
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
+        """Insert a new file record, optionally shared from the start."""
+        file_id = file_id or self._generate_id()
+        # Every value is already normalised, so the record is built directly
+        # instead of round-tripping through a document.
+        record = FileRecord(
+            id=file_id,
+            original_name=original_name,
+            stored_name=f"{file_id}{Path(original_name).suffix}",
+            size=int(file_size),
+            content_type=content_type,
+            uploaded_at_ms=time.time_ns() // 1_000_000,
+            owner_id=owner.id,
+            owner_username=owner.username,
+            share_token=share_token,
+            preview_type=preview_type_for(content_type),
+        )
+        with self.pool.transaction() as conn:
+            conn.execute(
+                SQL_INSERT_FILE,
                 (
-                    document["_id"],
-                    document["original_name"],
-                    document["stored_name"],
-                    document["size"],
-                    document["content_type"],
-                    document["uploaded_at"],
-                    document["owner_id"],
-                    document["owner_username"],
+                    record.id,
+                    record.original_name,
+                    record.stored_name,
+                    record.size,
+                    record.content_type,
+                    record.uploaded_at_iso,
+                    record.uploaded_at_ms,
+                    record.owner_id,
+                    record.owner_username,
+                    record.preview_type,
+                    record.share_token,
                 ),
             )
-        return FileRecord.from_document(document)
+            conn.execute(SQL_ADD_TO_STATS, (owner.id, record.size, record.size))
+        return record
 
-    def list_files(self, owner_id: str | None = None) -> list[FileRecord]:
-        if owner_id:
-            cursor = self.conn.execute(
-                "SELECT * FROM files WHERE owner_id = ? ORDER BY uploaded_at DESC",
-                (owner_id,),
-            )
-        else:
-            cursor = self.conn.execute(
-                "SELECT * FROM files ORDER BY uploaded_at DESC"
-            )
-        return [FileRecord.from_document(dict(row)) for row in cursor.fetchall()]
+    def iter_files(self, owner_id: str | None = None) -> t.Iterator[FileRecord]:
+        """Yield records newest first without materialising the result set."""
+        from_row = FileRecord._from_row
+        with self.pool.reader() as conn:
+            cursor = conn.cursor()
+            cursor.arraysize = LISTING_BATCH_SIZE
+            if owner_id:
+                cursor.execute(SQL_LIST_FILES_BY_OWNER, (owner_id,))
+            else:
+                cursor.execute(SQL_LIST_FILES)
+            while rows := cursor.fetchmany():
+                for row in rows:
+                    yield from_row(row)
+
+    def list_with_total(
+        self,
+        owner_id: str | None = None,
+        *,
+        limit: int | None = None,
+        offset: int = 0,
+    ) -> tuple[list[FileRecord], int]:
+        """Return a page of ``list_files(owner_id)`` and ``total_size(owner_id)``.
+
+        Both come from one query unless the page is empty.
+        """
+        page = (-1 if limit is None else limit, offset)
+        with self.pool.reader() as conn:
+            if owner_id:
+                cursor = conn.execute(
+                    SQL_LIST_FILES_BY_OWNER_WITH_TOTAL, (owner_id, *page)
+                )
+            else:
+                cursor = conn.execute(SQL_LIST_FILES_WITH_TOTAL, page)
+            first = cursor.fetchone()
+            if first is None:
+                if limit == 0 or offset:
+                    return [], self.total_size(owner_id)
+                return [], 0
+            from_row = FileRecord._from_row
+            records = [from_row(first)]
+            records.extend(map(from_row, cursor))
+        return records, int(first[-1] or 0)
 
     def total_size(self, owner_id: str | None = None) -> int:
-        if owner_id:
-            cursor = self.conn.execute(
-                "SELECT COALESCE(SUM(size), 0) FROM files WHERE owner_id = ?",
-                (owner_id,),
-            )
-        else:
-            cursor = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM files")
-        total = cursor.fetchone()[0] or 0
-        return int(total)
+        with self.pool.reader() as conn:
+            row = conn.execute(SQL_TOTAL_SIZE, (owner_id or "",)).fetchone()
+        return int(row[0]) if row else 0
 
     def remaining_capacity(self) -> int:
         return max(self.capacity - self.total_size(), 0)
 
     def get(self, file_id: str) -> FileRecord:
-        cursor = self.conn.execute(
-            "SELECT * FROM files WHERE _id = ?",
-            (file_id,),
-        )
-        row = cursor.fetchone()
+        with self.pool.reader() as conn:
+            row = conn.execute(SQL_GET_FILE, (file_id,)).fetchone()
         if row is None:
             raise KeyError(file_id)
-        return FileRecord.from_document(dict(row))
+        return FileRecord._from_row(row)
 
     def update_name(self, file_id: str, new_name: str) -> FileRecord:
-        with self._lock, self.conn:
-            cursor = self.conn.execute(
-                "UPDATE files SET original_name = ? WHERE _id = ?",
-                (new_name, file_id),
-            )
+        with self.pool.writer() as conn:
+            cursor = conn.execute(SQL_RENAME_FILE, (new_name, file_id))
             if cursor.rowcount == 0:
                 raise KeyError(file_id)
         return self.get(file_id)
 
     def delete(self, file_id: str) -> FileRecord:
         record = self.get(file_id)
-        with self._lock, self.conn:
-            self.conn.execute(
-                "DELETE FROM files WHERE _id = ?",
-                (file_id,),
-            )
+        with self.pool.transaction() as conn:
+            cursor = conn.execute(SQL_DELETE_FILE, (file_id,))
+            if cursor.rowcount:
+                conn.execute(
+                    SQL_SUBTRACT_FROM_STATS, (record.size, record.owner_id)
+                )
         return record
 
     def ensure_share_token(self, file_id: str) -> FileRecord:
         record = self.get(file_id)
         if record.share_token:
             return record
-        for _ in range(5):
-            token = secrets.token_urlsafe(12)
-            try:
-                with self._lock, self.conn:
-                    cursor = self.conn.execute(
-                        "UPDATE files SET share_token = ? WHERE _id = ?",
-                        (token, file_id),
-                    )
-                    if cursor.rowcount == 0:
-                        raise KeyError(file_id)
-                return self.get(file_id)
-            except sqlite3.IntegrityError:
-                continue
-        raise RuntimeError("Konnte keinen eindeutigen Freigabelink erzeugen.")
+        # 96 random bits make a collision practically impossible, so the
+        # token is written once instead of retried; on the off chance it
+        # does collide the request fails and can simply be repeated.
+        token = secrets.token_urlsafe(SHARE_TOKEN_BYTES)
+        try:
+            with self.pool.writer() as conn:
+                cursor = conn.execute(SQL_SET_SHARE_TOKEN, (token, file_id))
+                if cursor.rowcount == 0:
+                    raise KeyError(file_id)
+        except sqlite3.IntegrityError as exc:
+            raise RuntimeError("Konnte keinen eindeutigen Freigabelink erzeugen.") from exc
+        return replace(record, share_token=token)
 
     def remove_share_token(self, file_id: str) -> FileRecord:
-        with self._lock, self.conn:
-            cursor = self.conn.execute(
-                "UPDATE files SET share_token = NULL WHERE _id = ?",
-                (file_id,),
-            )
+        with self.pool.writer() as conn:
+            cursor = conn.execute(SQL_CLEAR_SHARE_TOKEN, (file_id,))
             if cursor.rowcount == 0:
                 raise KeyError(file_id)
         return self.get(file_id)
 
     def set_share_token(self, file_id: str, token: str) -> FileRecord:
         try:
-            with self._lock, self.conn:
-                cursor = self.conn.execute(
-                    "UPDATE files SET share_token = ? WHERE _id = ?",
-                    (token, file_id),
-                )
+            with self.pool.writer() as conn:
+                cursor = conn.execute(SQL_SET_SHARE_TOKEN, (token, file_id))
                 if cursor.rowcount == 0:
                     raise KeyError(file_id)
         except sqlite3.IntegrityError as exc:
@@ -299,27 +662,40 @@ class FileStore:
         return self.get(file_id)
 
     def update_owner_username(self, owner_id: str, new_username: str) -> None:
-        with self._lock, self.conn:
-            self.conn.execute(
-                "UPDATE files SET owner_username = ? WHERE owner_id = ?",
-                (new_username, owner_id),
-            )
+        with self.pool.writer() as conn:
+            conn.execute(SQL_RENAME_OWNER, (new_username, owner_id))
 
     def find_by_token(self, token: str) -> FileRecord:
-        cursor = self.conn.execute(
-            "SELECT * FROM files WHERE share_token = ?",
-            (token,),
-        )
-        row = cursor.fetchone()
+        # The UNIQUE constraint on share_token doubles as the lookup index, and
+        # reading it per request keeps revoked links dead in every worker.
+        with self.pool.reader() as conn:
+            row = conn.execute(SQL_FIND_FILE_BY_TOKEN, (token,)).fetchone()
         if row is None:
             raise KeyError(token)
-        return FileRecord.from_document(dict(row))
+        return FileRecord._from_row(row)
 
 
 class UserStore:
-    def __init__(self, connection: sqlite3.Connection) -> None:
-        self.conn = connection
-        self._lock = Lock()
+    def __init__(self, pool: ConnectionPool) -> None:
+        self.pool = pool
+        self._has_users = False
+        # Every session request resolves its user by id, so keep recent
+        # lookups in memory. Entries are dropped on mutation and expire after
+        # a short TTL to bound staleness across worker processes. API tokens
+        # are always checked against the database so that a regenerated key
+        # stops working in every worker at once.
+        self._cache_lock = Lock()
+        self._user_by_id: TTLCache[str, User] = TTLCache(
+            maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL
+        )
+
+    def _remember(self, user: User) -> None:
+        with self._cache_lock:
+            self._user_by_id[user.id] = user
+
+    def invalidate(self, user_id: str) -> None:
+        with self._cache_lock:
+            self._user_by_id.pop(user_id, None)
 
     def _from_document(self, document: dict[str, t.Any]) -> User:
         created_at = document.get("created_at")
@@ -337,11 +713,43 @@ class UserStore:
             copy_url_mode=(document.get("copy_url_mode") or "view"),
             client_config=document.get("client_config"),
             api_token=document.get("api_token"),
+            username_lower=document.get("username_lower")
+            or document["username"].lower(),
         )
 
+    def _from_row(self, row: t.Sequence[t.Any]) -> User:
+        # Column order follows USER_COLUMNS.
+        created_at = datetime.fromisoformat(row[4])
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        return User(
+            row[0],
+            row[1],
+            row[2],
+            bool(row[3]),
+            created_at,
+            bool(row[5]),
+            row[6] or "view",
+            row[7],
+            row[8],
+            row[9],
+        )
+
+    def _fetch_one(self, query: str, params: tuple[t.Any, ...]) -> User | None:
+        with self.pool.reader() as conn:
+            row = conn.execute(query, params).fetchone()
+        if row is None:
+            return None
+        return self._from_row(row)
+
     def has_users(self) -> bool:
-        cursor = self.conn.execute("SELECT 1 FROM users LIMIT 1")
-        return cursor.fetchone() is not None
+        # Users are never deleted, so once one exists the answer is final.
+        if self._has_users:
+            return True
+        with self.pool.reader() as conn:
+            row = conn.execute(SQL_HAS_USERS).fetchone()
+        self._has_users = row is not None
+        return self._has_users
 
     def create_user(self, username: str, password: str) -> User:
         username = (username or "").strip()
@@ -351,15 +759,13 @@ class UserStore:
         if len(password) < 8:
             raise ValueError("Das Passwort muss mindestens 8 Zeichen enthalten.")
         username_lower = username.lower()
-        existing = self.conn.execute(
-            "SELECT 1 FROM users WHERE username_lower = ?",
-            (username_lower,),
-        ).fetchone()
+        with self.pool.reader() as conn:
+            existing = conn.execute(SQL_USERNAME_TAKEN, (username_lower,)).fetchone()
         if existing:
             raise ValueError("Der Benutzername ist bereits vergeben.")
         user_id = secrets.token_hex(12)
         created_at = datetime.now(timezone.utc).isoformat()
-        password_hash = generate_password_hash(password)
+        password_hash = hash_password(password)
         is_admin = not self.has_users()
         api_token = secrets.token_hex(24)
         document = {
@@ -375,23 +781,9 @@ class UserStore:
             "api_token": api_token,
         }
         try:
-            with self._lock, self.conn:
-                self.conn.execute(
-                    """
-                    INSERT INTO users (
-                        _id,
-                        username,
-                        username_lower,
-                        password_hash,
-                        is_admin,
-                        created_at,
-                        hide_media_default,
-                        copy_url_mode,
-                        client_config,
-                        api_token
-                    )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
+            with self.pool.writer() as conn:
+                conn.execute(
+                    SQL_INSERT_USER,
                     (
                         document["_id"],
                         document["username"],
@@ -407,42 +799,32 @@ class UserStore:
                 )
         except sqlite3.IntegrityError as exc:
             raise ValueError("Der Benutzername ist bereits vergeben.") from exc
+        self._has_users = True
         return self._from_document(document)
 
     def get(self, user_id: str) -> User | None:
-        cursor = self.conn.execute(
-            "SELECT * FROM users WHERE _id = ?",
-            (user_id,),
-        )
-        row = cursor.fetchone()
-        if row is None:
-            return None
-        return self._from_document(dict(row))
+        with self._cache_lock:
+            cached = self._user_by_id.get(user_id)
+        if cached is not None:
+            return cached
+        user = self._fetch_one(SQL_GET_USER, (user_id,))
+        if user is not None:
+            self._remember(user)
+        return user
 
     def find_by_username(self, username: str) -> User | None:
         username = (username or "").strip().lower()
         if not username:
             return None
-        cursor = self.conn.execute(
-            "SELECT * FROM users WHERE username_lower = ?",
-            (username,),
-        )
-        row = cursor.fetchone()
-        if row is None:
-            return None
-        return self._from_document(dict(row))
+        return self._fetch_one(SQL_FIND_USER_BY_USERNAME, (username,))
 
     def get_by_token(self, token: str) -> User | None:
         if not token:
             return None
-        cursor = self.conn.execute(
-            "SELECT * FROM users WHERE api_token = ?",
-            (token,),
-        )
-        row = cursor.fetchone()
-        if row is None:
-            return None
-        return self._from_document(dict(row))
+        user = self._fetch_one(SQL_FIND_USER_BY_TOKEN, (token,))
+        if user is not None:
+            self._remember(user)
+        return user
 
     def authenticate(self, username: str, password: str) -> User | None:
         user = self.find_by_username(username)
@@ -450,8 +832,17 @@ class UserStore:
             return None
         if not user.check_password(password):
             return None
+        if password_needs_rehash(user.password_hash):
+            user = self._rehash_password(user, password)
         return user
 
+    def _rehash_password(self, user: User, password: str) -> User:
+        password_hash = hash_password(password)
+        with self.pool.writer() as conn:
+            conn.execute(SQL_UPDATE_PASSWORD_HASH, (password_hash, user.id))
+        self.invalidate(user.id)
+        return replace(user, password_hash=password_hash)
+
     def update_user(
         self,
         user: User,
@@ -468,11 +859,11 @@ class UserStore:
             if not username:
                 raise ValueError("Ein Benutzername ist erforderlich.")
             username_lower = username.lower()
-            if username_lower != user.username.lower():
-                existing = self.conn.execute(
-                    "SELECT 1 FROM users WHERE username_lower = ? AND _id != ?",
-                    (username_lower, user.id),
-                ).fetchone()
+            if username_lower != user.username_lower:
+                with self.pool.reader() as conn:
+                    existing = conn.execute(
+                        SQL_USERNAME_TAKEN_BY_OTHER, (username_lower, user.id)
+                    ).fetchone()
                 if existing:
                     raise ValueError("Der Benutzername ist bereits vergeben.")
                 updates["username"] = username
@@ -481,7 +872,7 @@ class UserStore:
         if password:
             if len(password) < 8:
                 raise ValueError("Das Passwort muss mindestens 8 Zeichen enthalten.")
-            updates["password_hash"] = generate_password_hash(password)
+            updates["password_hash"] = hash_password(password)
 
         if hide_media_default is not None:
             updates["hide_media_default"] = 1 if hide_media_default else 0
@@ -498,29 +889,87 @@ class UserStore:
         if not updates:
             return user
 
-        set_clause = ", ".join(f"{field} = ?" for field in updates)
-        params = list(updates.values()) + [user.id]
-        with self._lock, self.conn:
-            self.conn.execute(
-                f"UPDATE users SET {set_clause} WHERE _id = ?",
-                params,
-            )
+        mask = 0
+        params: list[t.Any] = []
+        for bit, field in enumerate(USER_UPDATE_FIELDS):
+            if field in updates:
+                mask |= 1 << bit
+                params.append(updates[field])
+        params.append(user.id)
+        with self.pool.writer() as conn:
+            conn.execute(SQL_UPDATE_USER[mask], params)
+        self.invalidate(user.id)
         updated = self.get(user.id)
         return updated or user
 
     def regenerate_api_token(self, user_id: str) -> str:
         token = secrets.token_hex(24)
-        with self._lock, self.conn:
-            self.conn.execute(
-                "UPDATE users SET api_token = ? WHERE _id = ?",
-                (token, user_id),
-            )
+        with self.pool.writer() as conn:
+            conn.execute(SQL_SET_API_TOKEN, (token, user_id))
+        self.invalidate(user_id)
         return token
 
 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that encodes and decodes with orjson.
+
+    Dates, dataclasses and anything else orjson does not handle itself still
+    go through Flask's ``default`` hook, so the output matches the stdlib
+    provider. Calls passing other ``json.dumps`` options than ``sort_keys``
+    (which Jinja's ``tojson`` always sends) use the stdlib encoder.
+    """
+
+    # Keys are emitted in insertion order, and responses stay compact even in
+    # debug mode.
+    sort_keys = False
+    compact = True
+    options = (
+        orjson.OPT_NON_STR_KEYS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+    )
+
+    def dumps(self, obj: t.Any, **kwargs: t.Any) -> str:
+        sort_keys = kwargs.pop("sort_keys", self.sort_keys)
+        if kwargs:
+            return super().dumps(obj, sort_keys=sort_keys, **kwargs)
+        return self.encode(obj, sort_keys=sort_keys).decode()
+
+    def encode(self, obj: t.Any, *, sort_keys: bool | None = None) -> bytes:
+        if sort_keys is None:
+            sort_keys = self.sort_keys
+        option = self.options | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, default=self.default, option=option)
+
+    def response(self, *args: t.Any, **kwargs: t.Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        body = self.encode(obj) + b"\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+    def loads(self, s: str | bytes, **kwargs: t.Any) -> t.Any:
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "change-me")
 app.config["DATABASE_PATH"] = os.environ.get("DATABASE_PATH", "fileshare.db")
+app.config["DATABASE_POOL_SIZE"] = int(
+    os.environ.get("DATABASE_POOL_SIZE", DEFAULT_POOL_SIZE)
+)
+# Let a fronting Apache (mod_xsendfile) or lighttpd stream downloads itself.
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE", "").lower() in {
+    "1",
+    "true",
+    "yes",
+}
+# nginx equivalent: the internal location that aliases UPLOAD_DIR, e.g.
+# "/_protected/" for ``location /_protected/ { internal; alias .../uploads/; }``.
+app.config["X_ACCEL_REDIRECT_PREFIX"] = os.environ.get("X_ACCEL_REDIRECT_PREFIX", "")
+if app.config["X_ACCEL_REDIRECT_PREFIX"]:
+    app.config["USE_X_SENDFILE"] = True
 
 
 def _get_database_path(app: Flask) -> Path:
@@ -534,18 +983,15 @@ def _get_database_path(app: Flask) -> Path:
     return path
 
 
-def _create_connection(app: Flask) -> sqlite3.Connection:
-    db_path = _get_database_path(app)
-    connection = sqlite3.connect(db_path, check_same_thread=False)
-    connection.row_factory = sqlite3.Row
-    connection.execute("PRAGMA foreign_keys = ON")
-    connection.execute("PRAGMA journal_mode = WAL")
-    connection.execute("PRAGMA busy_timeout = 5000")
-    return connection
+def _create_pool(app: Flask) -> ConnectionPool:
+    return ConnectionPool(
+        _get_database_path(app),
+        size=app.config.get("DATABASE_POOL_SIZE") or DEFAULT_POOL_SIZE,
+    )
 
 
-def _initialize_schema(connection: sqlite3.Connection) -> None:
-    with connection:
+def _initialize_schema(pool: ConnectionPool) -> None:
+    with pool.transaction() as connection:
         connection.execute(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -573,23 +1019,42 @@ def _initialize_schema(connection: sqlite3.Connection) -> None:
                 uploaded_at TEXT NOT NULL,
                 owner_id TEXT NOT NULL,
                 owner_username TEXT NOT NULL,
-                share_token TEXT UNIQUE
+                share_token TEXT UNIQUE,
+                uploaded_at_ms INTEGER,
+                preview_type TEXT NOT NULL DEFAULT 'none'
             )
             """
         )
+        # Running storage totals per owner; the row keyed by '' holds the
+        # total across all owners. Kept in sync by FileStore.create/delete.
+        stats_exists = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats'"
+        ).fetchone()
         connection.execute(
-            "CREATE INDEX IF NOT EXISTS idx_files_owner_uploaded ON files(owner_id, uploaded_at)"
-        )
-        connection.execute(
-            "CREATE INDEX IF NOT EXISTS idx_files_uploaded_at ON files(uploaded_at)"
+            """
+            CREATE TABLE IF NOT EXISTS stats (
+                owner_id TEXT PRIMARY KEY,
+                total INTEGER NOT NULL DEFAULT 0
+            )
+            """
         )
+        if not stats_exists:
+            connection.execute(
+                "INSERT INTO stats (owner_id, total) "
+                "SELECT owner_id, SUM(size) FROM files GROUP BY owner_id"
+            )
+            connection.execute(
+                "INSERT INTO stats (owner_id, total) "
+                "SELECT '', COALESCE(SUM(size), 0) FROM files"
+            )
 
         # Migrations for legacy databases
-        def _ensure_column(table: str, column: str, ddl: str) -> None:
+        def _ensure_column(table: str, column: str, ddl: str) -> bool:
             try:
                 connection.execute(f"ALTER TABLE {table} ADD COLUMN {ddl}")
             except sqlite3.OperationalError:
-                pass
+                return False
+            return True
 
         _ensure_column(
             "users",
@@ -606,22 +1071,132 @@ def _initialize_schema(connection: sqlite3.Connection) -> None:
         connection.execute(
             "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_api_token ON users(api_token) WHERE api_token IS NOT NULL"
         )
+        _ensure_column("files", "uploaded_at_ms", "uploaded_at_ms INTEGER")
+        # Computed in Python: SQLite's date functions round to the nearest
+        # millisecond, while new rows store time_ns() rounded down.
+        legacy_rows = connection.execute(
+            "SELECT _id, uploaded_at FROM files WHERE uploaded_at_ms IS NULL"
+        ).fetchall()
+        connection.executemany(
+            "UPDATE files SET uploaded_at_ms = ? WHERE _id = ?",
+            [
+                (datetime_to_ms(datetime.fromisoformat(uploaded_at)), file_id)
+                for file_id, uploaded_at in legacy_rows
+            ],
+        )
+        if _ensure_column(
+            "files",
+            "preview_type",
+            "preview_type TEXT NOT NULL DEFAULT 'none'",
+        ):
+            connection.execute(
+                """
+                UPDATE files SET preview_type = CASE
+                    WHEN content_type LIKE 'image/%' THEN 'image'
+                    WHEN content_type LIKE 'video/%' THEN 'video'
+                    WHEN content_type LIKE 'audio/%' THEN 'audio'
+                    WHEN content_type LIKE 'text/%' THEN 'text'
+                    ELSE 'none'
+                END
+                """
+            )
+
+        # Listings sort on uploaded_at_ms; the indexes on the ISO text column
+        # are superseded.
+        connection.execute("DROP INDEX IF EXISTS idx_files_uploaded_at")
+        connection.execute("DROP INDEX IF EXISTS idx_files_owner_uploaded")
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_files_owner_uploaded_ms ON files(owner_id, uploaded_at_ms)"
+        )
+        # Covers every column of FILE_COLUMNS so the admin listing is answered
+        # from the index alone.
+        connection.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_files_listing ON files(
+                uploaded_at_ms DESC,
+                owner_id,
+                _id,
+                original_name,
+                stored_name,
+                size,
+                content_type,
+                owner_username,
+                share_token,
+                preview_type
+            )
+            """
+        )
+
+
+db_pool = _create_pool(app)
+_initialize_schema(db_pool)
+file_store = FileStore(db_pool)
+user_store = UserStore(db_pool)
+delete_executor = ThreadPoolExecutor(
+    max_workers=DELETE_WORKERS, thread_name_prefix="delete"
+)
+
+
+def _open_upload_dir() -> int | None:
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    if os.stat not in os.supports_dir_fd:
+        return None
+    return os.open(UPLOAD_DIR, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+
+
+# Kept open so existence checks resolve names relative to the directory
+# instead of walking the full path each time.
+upload_dir_fd = _open_upload_dir()
+
 
+def _purge_leftovers() -> None:
+    """Unlink trash and stale partial uploads a previous process left behind.
 
-db_connection = _create_connection(app)
-_initialize_schema(db_connection)
-file_store = FileStore(db_connection)
-user_store = UserStore(db_connection)
+    Other workers may be writing partials right now; those are touched with
+    every chunk, so only ones idle for ``STALE_UPLOAD_SECONDS`` are removed.
+    """
+    stale_before = time.time() - STALE_UPLOAD_SECONDS
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            with suppress(FileNotFoundError):
+                if entry.name.startswith(".trash-") or (
+                    entry.name.startswith(".upload-")
+                    and entry.stat().st_mtime < stale_before
+                ):
+                    os.unlink(entry.path)
+
+
+_purge_leftovers()
+
+
+@app.before_request
+def checkout_db_connection() -> None:
+    g.db = db_pool.acquire()
+
+
+@app.teardown_request
+def release_db_connection(exc: BaseException | None = None) -> None:
+    connection = g.pop("db", None)
+    if connection is not None:
+        db_pool.release(connection)
 
 
 def is_safe_url(target: str | None) -> bool:
     if not target:
         return False
-    ref_url = urlparse(request.host_url)
     test_url = urlparse(urljoin(request.host_url, target))
+    # request.host is the netloc of request.host_url, no need to parse it.
     return (
         test_url.scheme in {"http", "https"}
-        and ref_url.netloc == test_url.netloc
+        and request.host == test_url.netloc
+    )
+
+
+def is_valid_custom_token(token: str) -> bool:
+    return (
+        4 <= len(token) <= 64
+        and token.isascii()
+        and not token.encode("ascii").translate(None, CUSTOM_TOKEN_BYTES)
     )
 
 
@@ -652,6 +1227,38 @@ def user_can_manage(record: FileRecord, user: User | None) -> bool:
     return user.is_admin or record.owner_id == user.id
 
 
+def managed_file(view):
+    """Resolve the ``file_id`` route argument to a record the user may manage."""
+
+    @wraps(view)
+    def wrapper(file_id: str, *args, **kwargs):
+        try:
+            record = file_store.get(file_id)
+        except KeyError:
+            abort(404)
+        if not user_can_manage(record, g.user):
+            abort(403)
+        return view(record, *args, **kwargs)
+
+    return wrapper
+
+
+def api_managed_file(view):
+    """Like :func:`managed_file`, answering with JSON errors."""
+
+    @wraps(view)
+    def wrapper(file_id: str, *args, **kwargs):
+        try:
+            record = file_store.get(file_id)
+        except KeyError:
+            return jsonify({"message": "Datei wurde nicht gefunden."}), 404
+        if not user_can_manage(record, g.user):
+            return jsonify({"message": "Keine Berechtigung."}), 403
+        return view(record, *args, **kwargs)
+
+    return wrapper
+
+
 def _extract_api_token() -> str | None:
     authorization = request.headers.get("Authorization", "")
     if authorization.lower().startswith("bearer "):
@@ -684,11 +1291,269 @@ def inject_user() -> dict[str, t.Any]:
     return {"current_user": g.get("user")}
 
 
-def _ensure_file_exists(record: FileRecord) -> Path:
-    file_path = UPLOAD_DIR / record.stored_name
-    if not file_path.exists():
+def _ensure_file_exists(record: FileRecord) -> None:
+    try:
+        if upload_dir_fd is not None:
+            os.stat(record.stored_name, dir_fd=upload_dir_fd)
+        else:
+            os.stat(UPLOAD_DIR / record.stored_name)
+    except FileNotFoundError:
+        abort(404)
+
+
+def _send_stored_file(record: FileRecord, *, as_attachment: bool) -> Response:
+    # Stored names are generated by FileStore.create, so the path skips the
+    # safe_join/isfile round trip of send_from_directory. send_file stats the
+    # file itself, so a missing upload needs no separate existence check.
+    accel_prefix = app.config["X_ACCEL_REDIRECT_PREFIX"]
+    try:
+        response = send_file(
+            UPLOAD_DIR / record.stored_name,
+            as_attachment=as_attachment,
+            download_name=record.original_name if as_attachment else None,
+            # Range and If-None-Match handling, so media seeks fetch 206 slices.
+            # Behind nginx the internal location answers those itself.
+            conditional=not accel_prefix,
+        )
+    except FileNotFoundError:
         abort(404)
-    return file_path
+    if accel_prefix:
+        # Keep the headers send_file built (type, disposition) and hand the
+        # body to nginx, which serves it with sendfile(2).
+        del response.headers["X-Sendfile"]
+        response.headers["X-Accel-Redirect"] = f"{accel_prefix}{record.stored_name}"
+    return response
+
+
+def _file_descriptor(stream: t.BinaryIO) -> int | None:
+    """Return the descriptor behind ``stream`` if it is an on-disk file."""
+    if isinstance(stream, SpooledTemporaryFile):
+        # Small multipart parts stay in memory; asking for their descriptor
+        # would force them onto disk first.
+        if not stream._rolled:
+            return None
+        stream = stream._file
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def _sendfile_upload(
+    source: int, offset: int, destination: str, *, limit: int
+) -> int | None:
+    size = os.fstat(source).st_size - offset
+    if size > limit:
+        return None
+    with open(destination, "wb") as fh:
+        written = 0
+        while written < size:
+            sent = os.sendfile(fh.fileno(), source, offset + written, size - written)
+            if not sent:
+                break
+            written += sent
+    return written
+
+
+def _write_upload(stream: t.BinaryIO, destination: str, *, limit: int) -> int | None:
+    """Copy ``stream`` to ``destination`` and return the number of bytes written.
+
+    Returns ``None`` and removes the partial file as soon as more than
+    ``limit`` bytes arrive.
+    """
+    # Parts the form parser spooled to disk are copied in the kernel.
+    source = _file_descriptor(stream)
+    if source is not None and hasattr(os, "sendfile"):
+        with suppress(OSError):
+            return _sendfile_upload(source, stream.tell(), destination, limit=limit)
+    try:
+        with open(destination, "wb") as fh:
+            written = _copy_stream(stream, fh, limit=limit)
+    except BaseException:
+        _discard_upload(destination)
+        raise
+    if written is None:
+        _discard_upload(destination)
+    return written
+
+
+def _copy_stream(stream: t.BinaryIO, fh: t.BinaryIO, *, limit: int) -> int | None:
+    written = 0
+    readinto = getattr(stream, "readinto", None)
+    if readinto is None:
+        # gunicorn hands over its raw request body, which only has read().
+        while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+            written += len(chunk)
+            if written > limit:
+                return None
+            fh.write(chunk)
+        return written
+    # Read into one preallocated buffer instead of allocating a fresh bytes
+    # object per chunk; writes of a full chunk bypass the file's own buffer.
+    buffer = memoryview(bytearray(UPLOAD_CHUNK_SIZE))
+    while count := readinto(buffer):
+        written += count
+        if written > limit:
+            return None
+        fh.write(buffer[:count])
+    return written
+
+
+def _discard_upload(partial: str) -> None:
+    with suppress(FileNotFoundError):
+        os.unlink(partial)
+
+
+def _remove_stored_file(stored_name: str) -> None:
+    """Take a deleted file out of the upload directory without waiting on it.
+
+    The rename is atomic and cheap; freeing the blocks of a large file is
+    not, so the unlink runs in the background. Trash left behind by a crash
+    is purged on the next start.
+    """
+    upload_dir = os.fspath(UPLOAD_DIR)
+    trash = os.path.join(upload_dir, f".trash-{stored_name}")
+    try:
+        os.rename(os.path.join(upload_dir, stored_name), trash)
+    except FileNotFoundError:
+        return
+    delete_executor.submit(_discard_upload, trash)
+
+
+def _new_upload_keys(count: int) -> list[tuple[str, str]]:
+    """Return ``count`` ``(file_id, share_token)`` pairs from one ``os.urandom`` call.
+
+    The values match ``secrets.token_hex`` and ``secrets.token_urlsafe``.
+    """
+    step = FILE_ID_BYTES + SHARE_TOKEN_BYTES
+    raw = os.urandom(step * count)
+    keys: list[tuple[str, str]] = []
+    for start in range(0, len(raw), step):
+        token = raw[start + FILE_ID_BYTES : start + step]
+        keys.append(
+            (
+                raw[start : start + FILE_ID_BYTES].hex(),
+                base64.urlsafe_b64encode(token).rstrip(b"=").decode("ascii"),
+            )
+        )
+    return keys
+
+
+def _stage_upload(
+    stream: t.BinaryIO, file_id: str, *, content_length: int | None, remaining: int
+) -> tuple[str, int] | None:
+    """Write ``stream`` to a temporary name and return ``(path, size)``.
+
+    Returns ``None`` when the upload does not fit into ``remaining`` bytes.
+    """
+    # Stream into a temporary name first so the record is created with
+    # the size actually written, without probing the upload up front.
+    if (content_length or 0) > remaining:
+        return None
+    # UPLOAD_DIR is created at import; plain string joins skip building Path
+    # objects for every file.
+    partial = os.path.join(os.fspath(UPLOAD_DIR), f".upload-{file_id}")
+    size = _write_upload(stream, partial, limit=remaining)
+    if size is None:
+        return None
+    return partial, size
+
+
+def _commit_upload(
+    partial: str,
+    size: int,
+    filename: str,
+    *,
+    file_id: str,
+    share_token: str,
+    content_type: str,
+    owner: User,
+) -> FileRecord:
+    """Create the shared record for a staged upload and move it into place."""
+    try:
+        record = file_store.create(
+            filename,
+            content_type=content_type,
+            file_size=size,
+            owner=owner,
+            file_id=file_id,
+            share_token=share_token,
+        )
+    except BaseException:
+        _discard_upload(partial)
+        raise
+    os.replace(partial, os.path.join(os.fspath(UPLOAD_DIR), record.stored_name))
+    return record
+
+
+def _stage_uploads(
+    uploads: list[tuple[str, FileStorage]], file_ids: list[str], *, remaining: int
+) -> list[tuple[str, int] | None]:
+    """Stage every upload, writing several files to disk concurrently.
+
+    Each request gets its own threads, so a large batch cannot hold up other
+    uploads. Under gevent those threads would be greenlets running the
+    blocking file I/O one after another, so parts are staged in order there.
+    """
+    if len(uploads) < 2 or _green_threads():
+        return [
+            _stage_upload(
+                storage.stream,
+                file_id,
+                content_length=storage.content_length,
+                remaining=remaining,
+            )
+            for (_, storage), file_id in zip(uploads, file_ids)
+        ]
+    staged: list[tuple[str, int] | None] = []
+    error: BaseException | None = None
+    with ThreadPoolExecutor(
+        max_workers=min(len(uploads), UPLOAD_WORKERS), thread_name_prefix="upload"
+    ) as executor:
+        futures = [
+            executor.submit(
+                _stage_upload,
+                storage.stream,
+                file_id,
+                content_length=storage.content_length,
+                remaining=remaining,
+            )
+            for (_, storage), file_id in zip(uploads, file_ids)
+        ]
+        for future in futures:
+            try:
+                staged.append(future.result())
+            except BaseException as exc:  # wait for the others before cleaning up
+                error = error or exc
+                staged.append(None)
+    if error is not None:
+        for result in staged:
+            if result is not None:
+                _discard_upload(result[0])
+        raise error
+    return staged
+
+
+def _upload_response(saved_files: list[dict[str, t.Any]]) -> Response:
+    status_code = 200 if saved_files else 400
+    message = "Upload abgeschlossen." if saved_files else "Keine Dateien wurden hochgeladen."
+    
+    # Build response with URL fields at root level for ShareX compatibility
+    response_data: dict[str, t.Any] = {
+        "message": message,
+        "files": saved_files,
+    }
+    
+    # Add first file's URLs at root level for ShareX compatibility
+    if saved_files:
+        first_file = saved_files[0]
+        response_data["url"] = first_file.get("view_url")
+        response_data["view_url"] = first_file.get("view_url")
+        response_data["download_url"] = first_file.get("download_url")
+        response_data["share_url"] = first_file.get("share_url")
+        response_data["share_raw_url"] = first_file.get("share_raw_url")
+    
+    return jsonify(response_data), status_code
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -725,6 +1590,8 @@ def login() -> Response | str:
 @app.route("/logout")
 @login_required
 def logout() -> Response:
+    if g.user:
+        user_store.invalidate(g.user.id)
     session.clear()
     return redirect(url_for("login"))
 
@@ -765,12 +1632,9 @@ def register() -> Response | str:
 @login_required
 def index() -> str:
     user = t.cast(User, g.user)
-    if user.is_admin:
-        records = file_store.list_files()
-        total_size = file_store.total_size()
-    else:
-        records = file_store.list_files(owner_id=user.id)
-        total_size = file_store.total_size(owner_id=user.id)
+    records, total_size = file_store.list_with_total(
+        owner_id=None if user.is_admin else user.id
+    )
     include_owner = True
     files = [
         record.to_dict(current_user=user, include_owner=include_owner)
@@ -798,7 +1662,7 @@ def profile() -> str:
         action = request.form.get("action") or "update"
         if action == "regenerate-token":
             token = user_store.regenerate_api_token(user.id)
-            user.api_token = token
+            user = replace(user, api_token=token)
             g.user = user
             success = "API-Schlüssel wurde erneuert."
         else:
@@ -839,29 +1703,39 @@ def profile() -> str:
     )
 
 
+def _export_fragment(record: FileRecord, user: User) -> bytes:
+    """Return ``record`` as it appears in the export, indented for the files list."""
+    return b"    " + orjson.dumps(
+        record.to_dict(current_user=user, include_owner=True),
+        option=orjson.OPT_INDENT_2,
+    ).replace(b"\n", b"\n    ")
+
+
 @app.get("/profile/export")
 @login_required
 def export_profile() -> Response:
     user = t.cast(User, g.user)
-    files = file_store.list_files(owner_id=user.id)
-    payload = {
-        "user": {
-            "id": user.id,
-            "username": user.username,
-            "created_at": user.created_at.isoformat(),
-            "hide_media_default": user.hide_media_default,
-            "copy_url_mode": user.copy_url_mode,
-            "client_config": user.client_config,
+    header = orjson.dumps(
+        {
+            "user": {
+                "id": user.id,
+                "username": user.username,
+                "created_at": user.created_at.isoformat(),
+                "hide_media_default": user.hide_media_default,
+                "copy_url_mode": user.copy_url_mode,
+                "client_config": user.client_config,
+            },
         },
-        "files": [
-            file.to_dict(current_user=user, include_owner=True)
-            for file in files
-        ],
-    }
-    response = Response(
-        json.dumps(payload, ensure_ascii=False, indent=2),
-        mimetype="application/json",
+        option=orjson.OPT_INDENT_2,
     )
+    fragments = [
+        _export_fragment(file, user)
+        for file in file_store.iter_files(owner_id=user.id)
+    ]
+    files_json = b"[\n" + b",\n".join(fragments) + b"\n  ]" if fragments else b"[]"
+    # Same layout as dumping the whole payload with "files" after "user".
+    body = header[:-2] + b',\n  "files": ' + files_json + b"\n}"
+    response = Response(body, mimetype="application/json")
     filename = f"fileshare-export-{user.username}.json"
     response.headers["Content-Disposition"] = f"attachment; filename={filename}"
     return response
@@ -873,111 +1747,152 @@ def upload_files() -> Response:
     if "files" not in request.files:
         return jsonify({"message": "Es wurden keine Dateien übermittelt."}), 400
 
-    files = request.files.getlist("files")
-    user = t.cast(User, g.user)
-    saved_files: list[dict[str, t.Any]] = []
-    for file_storage in files:
+    uploads: list[tuple[str, FileStorage]] = []
+    for file_storage in request.files.getlist("files"):
         if not file_storage.filename:
             continue
         filename = secure_filename(file_storage.filename)
-        if not filename:
-            continue
+        if filename:
+            uploads.append((filename, file_storage))
 
-        file_storage.stream.seek(0, os.SEEK_END)
-        size = file_storage.stream.tell()
-        file_storage.stream.seek(0)
-
-        if size > file_store.remaining_capacity():
-            return (
-                jsonify(
-                    {
-                        "message": "Nicht genügend Speicherplatz verfügbar.",
-                        "files": saved_files,
-                    }
-                ),
-                413,
+    user = t.cast(User, g.user)
+    saved_files: list[dict[str, t.Any]] = []
+    # Read the capacity once and account for each stored file locally rather
+    # than querying the stats table again for every part of the request.
+    remaining = file_store.remaining_capacity()
+    # Disk writes overlap across files; records are created in request order.
+    keys = _new_upload_keys(len(uploads))
+    file_ids = [file_id for file_id, _ in keys]
+    staged = _stage_uploads(uploads, file_ids, remaining=remaining)
+    committed = 0
+    try:
+        for (filename, file_storage), (file_id, token), result in zip(
+            uploads, keys, staged
+        ):
+            if result is None or result[1] > remaining:
+                return (
+                    jsonify(
+                        {
+                            "message": "Nicht genügend Speicherplatz verfügbar.",
+                            "files": saved_files,
+                        }
+                    ),
+                    413,
+                )
+
+            partial, size = result
+            committed += 1
+            record = _commit_upload(
+                partial,
+                size,
+                filename,
+                file_id=file_id,
+                share_token=token,
+                content_type=file_storage.mimetype or "application/octet-stream",
+                owner=user,
             )
+            remaining -= size
+            saved_files.append(record.to_dict(current_user=user, include_owner=True))
+    finally:
+        # Staged files past an overflow or error never get a record.
+        for leftover in staged[committed:]:
+            if leftover is not None:
+                _discard_upload(leftover[0])
 
-        record = file_store.create(
-            filename,
-            content_type=file_storage.mimetype or "application/octet-stream",
-            file_size=size,
-            owner=user,
-        )
-        UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-        destination = UPLOAD_DIR / record.stored_name
-        file_storage.save(destination)
+    return _upload_response(saved_files)
 
-        record = file_store.ensure_share_token(record.id)
-        saved_files.append(record.to_dict(current_user=user, include_owner=True))
 
-    status_code = 200 if saved_files else 400
-    message = "Upload abgeschlossen." if saved_files else "Keine Dateien wurden hochgeladen."
-    
-    # Build response with URL fields at root level for ShareX compatibility
-    response_data: dict[str, t.Any] = {
-        "message": message,
-        "files": saved_files,
-    }
-    
-    # Add first file's URLs at root level for ShareX compatibility
-    if saved_files:
-        first_file = saved_files[0]
-        response_data["url"] = first_file.get("view_url")
-        response_data["view_url"] = first_file.get("view_url")
-        response_data["download_url"] = first_file.get("download_url")
-        response_data["share_url"] = first_file.get("share_url")
-        response_data["share_raw_url"] = first_file.get("share_raw_url")
-    
-    return jsonify(response_data), status_code
+@app.post("/api/upload-stream")
+@api_login_required
+def upload_stream() -> Response:
+    """Store the raw request body as a single file named by ``X-Filename``."""
+    filename = secure_filename(unquote(request.headers.get("X-Filename", "")))
+    if not filename:
+        return jsonify({"message": "Es wurde kein Dateiname übermittelt."}), 400
+
+    content_type = request.mimetype
+    if not content_type or content_type in STREAM_FORM_MIMETYPES:
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    [(file_id, token)] = _new_upload_keys(1)
+    staged = _stage_upload(
+        request.stream,
+        file_id,
+        content_length=request.content_length,
+        remaining=file_store.remaining_capacity(),
+    )
+    if staged is None:
+        return (
+            jsonify({"message": "Nicht genügend Speicherplatz verfügbar.", "files": []}),
+            413,
+        )
+    user = t.cast(User, g.user)
+    record = _commit_upload(
+        *staged,
+        filename,
+        file_id=file_id,
+        share_token=token,
+        content_type=content_type,
+        owner=user,
+    )
+    return _upload_response([record.to_dict(current_user=user, include_owner=True)])
 
 
 @app.get("/api/files")
 @api_login_required
 def list_files() -> Response:
     user = t.cast(User, g.user)
-    if user.is_admin:
-        records = file_store.list_files()
-        total_size = file_store.total_size()
-    else:
-        records = file_store.list_files(owner_id=user.id)
-        total_size = file_store.total_size(owner_id=user.id)
-    include_owner = True
-    files = [
-            record.to_dict(current_user=user, include_owner=include_owner)
-        for record in records
-    ]
-    return jsonify(
-        {
-            "files": files,
-            "total_size": total_size,
-            "capacity": file_store.capacity,
-            "preferences": {
-                "hide_media_default": user.hide_media_default,
-                "copy_url_mode": user.copy_url_mode,
-            },
-        }
+    # Without ?limit= the full listing is returned, as the web UI expects;
+    # paged requests are capped so one call stays bounded.
+    limit = request.args.get("limit", type=int)
+    if limit is not None:
+        limit = min(max(limit, 0), MAX_PAGE_SIZE)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    records, total_size = file_store.list_with_total(
+        owner_id=None if user.is_admin else user.id,
+        limit=limit,
+        offset=offset,
     )
+    include_owner = True
+    meta: dict[str, t.Any] = {
+        "total_size": total_size,
+        "capacity": file_store.capacity,
+        "preferences": {
+            "hide_media_default": user.hide_media_default,
+            "copy_url_mode": user.copy_url_mode,
+        },
+    }
+    if limit is not None:
+        meta["next_offset"] = offset + limit if limit and len(records) == limit else None
+    summary = app.json.encode(meta)
+
+    # Same document jsonify would produce, encoded one batch of files at a
+    # time so large listings start sending before every record is serialised.
+    def generate() -> t.Iterator[bytes]:
+        yield b'{"files":['
+        for start in range(0, len(records), LISTING_BATCH_SIZE):
+            batch = [
+                record.to_dict(current_user=user, include_owner=include_owner)
+                for record in records[start : start + LISTING_BATCH_SIZE]
+            ]
+            yield (b"," if start else b"") + app.json.encode(batch)[1:-1]
+        yield b"]," + summary[1:] + b"\n"
+
+    if len(records) <= LISTING_BATCH_SIZE:
+        return Response(b"".join(generate()), mimetype="application/json")
+    return Response(stream_with_context(generate()), mimetype="application/json")
 
 
 @app.post("/api/files/<file_id>/rename")
 @api_login_required
-def rename_file(file_id: str) -> Response:
+@api_managed_file
+def rename_file(record: FileRecord) -> Response:
     payload = request.get_json(silent=True) or {}
     new_name = (payload.get("name") or "").strip()
     if not new_name:
         return jsonify({"message": "Ein neuer Dateiname ist erforderlich."}), 400
 
     user = t.cast(User, g.user)
-    try:
-        record = file_store.get(file_id)
-    except KeyError:
-        return jsonify({"message": "Datei wurde nicht gefunden."}), 404
-
-    if not user_can_manage(record, user):
-        return jsonify({"message": "Keine Berechtigung."}), 403
-
-    record = file_store.update_name(file_id, new_name)
+    record = file_store.update_name(record.id, new_name)
     return jsonify(
         {
             "message": "Datei wurde umbenannt.",
@@ -988,45 +1903,27 @@ def rename_file(file_id: str) -> Response:
 
 @app.delete("/api/files/<file_id>")
 @api_login_required
-def delete_file(file_id: str) -> Response:
-    user = t.cast(User, g.user)
-    try:
-        record = file_store.get(file_id)
-    except KeyError:
-        return jsonify({"message": "Datei wurde nicht gefunden."}), 404
-
-    if not user_can_manage(record, user):
-        return jsonify({"message": "Keine Berechtigung."}), 403
-
-    record = file_store.delete(file_id)
-    file_path = UPLOAD_DIR / record.stored_name
-    if file_path.exists():
-        file_path.unlink()
+@api_managed_file
+def delete_file(record: FileRecord) -> Response:
+    record = file_store.delete(record.id)
+    _remove_stored_file(record.stored_name)
 
     return jsonify({"message": "Datei wurde gelöscht."})
 
 
 @app.post("/api/files/<file_id>/share")
 @api_login_required
-def create_share_link(file_id: str) -> Response:
-    user = t.cast(User, g.user)
-    try:
-        record = file_store.get(file_id)
-    except KeyError:
-        return jsonify({"message": "Datei wurde nicht gefunden."}), 404
-
-    if not user_can_manage(record, user):
-        return jsonify({"message": "Keine Berechtigung."}), 403
-
-    record = file_store.ensure_share_token(file_id)
-    preview_type = record.preview_category()
+@api_managed_file
+def create_share_link(record: FileRecord) -> Response:
+    record = file_store.ensure_share_token(record.id)
+    urls = file_url_templates()
     share_raw = None
-    if preview_type in {"image", "video", "audio"} and record.share_token:
-        share_raw = url_for("serve_shared_file_raw", token=record.share_token, _external=True)
+    if record.preview_type in MEDIA_PREVIEW_TYPES and record.share_token:
+        share_raw = urls.share_raw.build(record.share_token)
     return jsonify(
         {
             "message": "Freigabelink wurde erstellt.",
-            "share_url": url_for("serve_shared_file", token=record.share_token, _external=True),
+            "share_url": urls.share.build(record.share_token),
             "share_raw_url": share_raw,
             "share_token": record.share_token,
         }
@@ -1035,12 +1932,13 @@ def create_share_link(file_id: str) -> Response:
 
 @app.post("/api/files/<file_id>/custom-url")
 @api_login_required
-def set_custom_share_url(file_id: str) -> Response:
+@api_managed_file
+def set_custom_share_url(record: FileRecord) -> Response:
     payload = request.get_json(silent=True) or {}
     slug = (payload.get("slug") or "").strip()
     if not slug:
         return jsonify({"message": "Eine benutzerdefinierte URL ist erforderlich."}), 400
-    if not CUSTOM_TOKEN_PATTERN.match(slug):
+    if not is_valid_custom_token(slug):
         return (
             jsonify(
                 {
@@ -1051,15 +1949,7 @@ def set_custom_share_url(file_id: str) -> Response:
         )
     user = t.cast(User, g.user)
     try:
-        record = file_store.get(file_id)
-    except KeyError:
-        return jsonify({"message": "Datei wurde nicht gefunden."}), 404
-
-    if not user_can_manage(record, user):
-        return jsonify({"message": "Keine Berechtigung."}), 403
-
-    try:
-        record = file_store.set_share_token(file_id, slug)
+        record = file_store.set_share_token(record.id, slug)
     except ValueError as exc:
         return jsonify({"message": str(exc)}), 400
 
@@ -1074,76 +1964,37 @@ def set_custom_share_url(file_id: str) -> Response:
 
 @app.delete("/api/files/<file_id>/share")
 @api_login_required
-def revoke_share_link(file_id: str) -> Response:
-    user = t.cast(User, g.user)
-    try:
-        record = file_store.get(file_id)
-    except KeyError:
-        return jsonify({"message": "Datei wurde nicht gefunden."}), 404
-
-    if not user_can_manage(record, user):
-        return jsonify({"message": "Keine Berechtigung."}), 403
-
-    file_store.remove_share_token(file_id)
+@api_managed_file
+def revoke_share_link(record: FileRecord) -> Response:
+    file_store.remove_share_token(record.id)
     return jsonify({"message": "Freigabelink wurde entfernt."})
 
 
 @app.get("/api/files/<file_id>/download")
 @login_required
-def download_file(file_id: str):
-    try:
-        record = file_store.get(file_id)
-    except KeyError:
-        abort(404)
-    if not user_can_manage(record, g.user):
-        abort(403)
-    _ensure_file_exists(record)
-    return send_from_directory(
-        UPLOAD_DIR,
-        record.stored_name,
-        as_attachment=True,
-        download_name=record.original_name,
-    )
+@managed_file
+def download_file(record: FileRecord):
+    return _send_stored_file(record, as_attachment=True)
 
 
 @app.get("/files/<file_id>/raw")
 @login_required
-def serve_file_raw(file_id: str):
-    try:
-        record = file_store.get(file_id)
-    except KeyError:
-        abort(404)
-    if not user_can_manage(record, g.user):
-        abort(403)
-    _ensure_file_exists(record)
-    return send_from_directory(
-        UPLOAD_DIR,
-        record.stored_name,
-        as_attachment=False,
-    )
+@managed_file
+def serve_file_raw(record: FileRecord):
+    return _send_stored_file(record, as_attachment=False)
 
 
 @app.get("/files/<file_id>")
 @login_required
-def view_file(file_id: str):
-    try:
-        record = file_store.get(file_id)
-    except KeyError:
-        abort(404)
-
-    if not user_can_manage(record, g.user):
-        abort(403)
-
+@managed_file
+def view_file(record: FileRecord):
     _ensure_file_exists(record)
-    preview_type = record.preview_category()
-    share_url = (
-        url_for("serve_shared_file", token=record.share_token, _external=True)
-        if record.share_token
-        else None
-    )
+    preview_type = record.preview_type
+    urls = file_url_templates()
+    share_url = urls.share.build(record.share_token) if record.share_token else None
     share_raw_url = (
-        url_for("serve_shared_file_raw", token=record.share_token, _external=True)
-        if record.share_token and preview_type in {"image", "video", "audio"}
+        urls.share_raw.build(record.share_token)
+        if record.share_token and preview_type in MEDIA_PREVIEW_TYPES
         else None
     )
     return render_template(
@@ -1151,7 +2002,7 @@ def view_file(file_id: str):
         file_name=record.original_name,
         raw_url=url_for("serve_file_raw", file_id=record.id),
         download_url=url_for("download_file", file_id=record.id),
-        uploaded_at=record.uploaded_at.isoformat(),
+        uploaded_at=record.uploaded_at_iso,
         share_url=share_url,
         share_raw_url=share_raw_url,
         is_shared=False,
@@ -1161,63 +2012,52 @@ def view_file(file_id: str):
     )
 
 
-@app.get("/s/<token>")
-def serve_shared_file(token: str):
+def _shared_record(token: str) -> FileRecord:
+    # Every share token, generated or custom, passes the custom token check,
+    # so malformed links are rejected without touching the database.
+    if not is_valid_custom_token(token):
+        abort(404)
     try:
-        record = file_store.find_by_token(token)
+        return file_store.find_by_token(token)
     except KeyError:
         abort(404)
-    _ensure_file_exists(record)
-    preview_type = record.preview_category()
-    if preview_type in {"image", "video", "audio"}:
+
+
+@app.get("/s/<token>")
+def serve_shared_file(token: str):
+    record = _shared_record(token)
+    preview_type = record.preview_type
+    if preview_type in MEDIA_PREVIEW_TYPES:
+        # Only the rendered viewer needs the check; send_file below stats the
+        # upload itself and answers 404 when it is gone.
+        _ensure_file_exists(record)
+        urls = file_url_templates()
         return render_template(
             "view_file.html",
             file_name=record.original_name,
             raw_url=url_for("serve_shared_file_raw", token=token),
             download_url=url_for("download_shared_file", token=token),
-            uploaded_at=record.uploaded_at.isoformat(),
-            share_url=url_for("serve_shared_file", token=token, _external=True),
-            share_raw_url=url_for("serve_shared_file_raw", token=token, _external=True),
+            uploaded_at=record.uploaded_at_iso,
+            share_url=urls.share.build(token),
+            share_raw_url=urls.share_raw.build(token),
             is_shared=True,
             preview_type=preview_type,
             content_type=record.content_type,
             can_manage=False,
         )
-    return send_from_directory(
-        UPLOAD_DIR,
-        record.stored_name,
-        as_attachment=True,
-        download_name=record.original_name,
-    )
+    return _send_stored_file(record, as_attachment=True)
 
 
 @app.get("/s/<token>/raw")
 def serve_shared_file_raw(token: str):
-    try:
-        record = file_store.find_by_token(token)
-    except KeyError:
-        abort(404)
-    _ensure_file_exists(record)
-    return send_from_directory(
-        UPLOAD_DIR,
-        record.stored_name,
-        as_attachment=False,
-    )
+    record = _shared_record(token)
+    return _send_stored_file(record, as_attachment=False)
 
 
 @app.get("/s/<token>/download")
 def download_shared_file(token: str):
-    try:
-        record = file_store.find_by_token(token)
-    except KeyError:
-        abort(404)
-    _ensure_file_exists(record)
-    return send_from_directory(
-        UPLOAD_DIR,
-        record.stored_name,
-        as_attachment=True,
-        download_name=record.original_name,
-    )
+    record = _shared_record(token)
+    return _send_stored_file(record, as_attachment=True)
 
 
 @app.get("/sharex-config")
@@ -1226,7 +2066,7 @@ def sharex_config() -> Response:
     user = t.cast(User, g.user)
     if not user.api_token:
         token = user_store.regenerate_api_token(user.id)
-        user.api_token = token
+        user = replace(user, api_token=token)
     url_mode = user.copy_url_mode or "view"
     url_template = "$json:view_url$"
     if url_mode == "download":
@@ -0,0 +1,29 @@
+"""Production entrypoint.
+
+Run with gevent workers so each worker serves many transfers at once::
+
+    gunicorn -k gevent --workers 4 --worker-connections 1000 wsgi:app
+
+The gevent worker monkey-patches the standard library before it loads this
+module; sync and threaded workers run unpatched. ``app.run`` in ``app.py``
+remains for local development only.
+"""
+
+import os
+
+# Idle read connections kept per worker under gevent. Every in-flight request
+# holds one, so a pool sized for a handful of threads would open and close a
+# connection for most requests once hundreds of greenlets share a worker.
+GEVENT_POOL_SIZE = 100
+
+try:
+    from gevent.monkey import is_module_patched
+except ImportError:
+    pass
+else:
+    if is_module_patched("socket"):
+        os.environ.setdefault("DATABASE_POOL_SIZE", str(GEVENT_POOL_SIZE))
+
+from app import app  # noqa: E402
+
+__all__ = ["app"]